@@ -4,7 +4,6 @@ from copy import copy
 
 from config import BASE_PATH
 from src.model.q_learning import CircuitType
-from src.model.tsp_q_learning import QLearningTsp, QLearningTspAnalytical
 
 
 def run_tsp(hyperparams, path):
@@ -29,7 +28,9 @@ def run_tsp(hyperparams, path):
         if hyperparams.get('repetitions', 1) > 1:
             save_as_instance += f'_{i}'
 
+        # imported here, so the analytic runs do not load TensorFlow
         if hyperparams.get('circuit_type') == CircuitType.ANALYTIC:
+            from src.model.tsp_q_learning_analytical import QLearningTspAnalytical
             tsp_multi = QLearningTspAnalytical(
                 hyperparams=hyperparams,
                 save=save,
@@ -37,6 +38,7 @@ def run_tsp(hyperparams, path):
                 path=path,
                 test=test)
         else:
+            from src.model.tsp_q_learning import QLearningTsp
             tsp_multi = QLearningTsp(
                 hyperparams=hyperparams,
                 save=save,
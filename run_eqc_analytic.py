@@ -1,7 +1,5 @@
-import tensorflow as tf
-
 from src.utils.limit_thread_usage import set_thread_usage_limit
-set_thread_usage_limit(10, tf)
+set_thread_usage_limit(10) # the analytic model does not use TensorFlow
 
 from src.model.q_learning import CircuitType
 from run import run_tsp
@@ -1,9 +1,11 @@
 import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 
-import tensorflow as tf
-from collections import deque
+import numpy as np
+from collections import deque, namedtuple
 from config import BASE_PATH
 
 
@@ -14,6 +16,42 @@ class CircuitType(Enum):
     ANALYTIC = 'analytic'
 
 
+class ReplayBuffer:
+    '''
+    Replay buffer with a fixed capacity, stored as one preallocated array per
+    transition field. Once full, the oldest transitions are overwritten.
+    '''
+    def __init__(self, capacity, fields):
+        '''
+        fields: dict of field name -> (shape, dtype) of a single entry, in the
+        order of the transition tuples. Entries of varying size (e.g. partial
+        tours) use dtype=object.
+        '''
+        self.capacity = capacity
+        self.interaction = namedtuple('interaction', fields.keys())
+        self.data = [
+            np.empty((capacity,) + tuple(shape), dtype=dtype) for shape, dtype in fields.values()]
+        self.write_ix = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, transition):
+        for field, value in zip(self.data, transition):
+            field[self.write_ix] = value
+        self.write_ix = (self.write_ix + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size):
+        '''
+        Draws batch_size transitions uniformly at random (with replacement),
+        returned as one array per field.
+        '''
+        ix = np.random.randint(0, self.size, batch_size)
+        return self.interaction(*[field[ix] for field in self.data])
+
+
 class QLearning:
     '''
     Q-Learning Module
@@ -31,7 +69,8 @@ class QLearning:
         self.n_layers = hyperparams.get('n_layers')
         self.update_after = hyperparams.get('update_after')
         self.update_target_after = hyperparams.get('update_target_after')
-        self.memory_length = hyperparams.get('memory_length')
+        self.save_after = hyperparams.get('save_after', 50)
+        self.memory_length = hyperparams.get('memory_length', 10000)
         self.use_reuploading = hyperparams.get('use_reuploading', False)
         self.trainable_scaling = hyperparams.get('trainable_scaling', False)
         self.trainable_obs_weight = hyperparams.get('trainable_obs_weight', False)
@@ -46,40 +85,23 @@ class QLearning:
         self.learning_rate = hyperparams.get('learning_rate', 0.01)
         self.learning_rate_out = hyperparams.get('learning_rate_out', 0.01)
         self.learning_rate_in = hyperparams.get('learning_rate_in', 0.01)
-        self.optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate, amsgrad=True)
-        self.optimizer_output = tf.keras.optimizers.Adam(learning_rate=self.learning_rate_out)
-        self.optimizer_input = tf.keras.optimizers.Adam(learning_rate=self.learning_rate_in)
-
-        self.optimizers = []
-        self.w_idx = []
-
-        if self.circuit_type == CircuitType.HWE:
-            self.optimizers = [self.optimizer]
-            self.w_idx = [0]
-
-        if self.trainable_scaling:
-            self.optimizers.append(self.optimizer_input)
-            self.w_idx.append(self.optimizers.index(self.optimizer_input))
+        # optimizers and the loss function are set up by the TF based subclass
 
-        if self.trainable_obs_weight:
-            self.optimizers.append(self.optimizer_output)
-            self.w_idx.append(self.optimizers.index(self.optimizer_output))
-
-        self.loss_fun = tf.keras.losses.mse
         # store past experiences (replay buffer)
         self.memory = self.initialize_memory()
         self.initialize_save_dir()
 
         self.meta = self.generate_meta_data_dict()
+        # single background thread for writing the training history
+        self.save_pool = ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
 
     def generate_meta_data_dict(self):
         meta = {key: str(value) for key, value in self.__dict__.items() if
                 not key.startswith('__') and not callable(key)}
 
-        del meta['optimizer']
-        del meta['optimizer_output']
-        del meta['loss_fun']
-        del meta['memory']
+        for key in ('optimizer', 'optimizer_output', 'loss_fun', 'memory'):
+            meta.pop(key, None)
 
         return meta
 
@@ -87,17 +109,32 @@ class QLearning:
         memory = deque(maxlen=self.memory_length)
         return memory
 
-    def add_to_memory(self, state, action, reward, next_state, done):
-        '''
-        self.interaction is a namedtuple(
-            'interaction', ('state', 'action', 'reward', 'next_state', 'done', 'partial_tour', 'edge_weights'))
-        '''
-        transition = self.interaction(
-            state, action, reward, next_state, float(done))
-        self.memory.append(transition)
-
     def initialize_save_dir(self):
         if self.save:
             check_path = Path(self.path)
             if not check_path.exists():
                 os.makedirs(self.path)
+
+    def save_history(self, meta, tour_lengths, optimal_tour_lengths):
+        with open(self.path + '{}_meta.pickle'.format(self.save_as), 'wb') as file:
+            pickle.dump(meta, file)
+
+        with open(self.path + '{}_tour_lengths.pickle'.format(self.save_as), 'wb') as file:
+            pickle.dump(tour_lengths, file)
+
+        with open(self.path + '{}_optimal_lengths.pickle'.format(self.save_as), 'wb') as file:
+            pickle.dump(optimal_tour_lengths, file)
+
+    def save_history_async(self, meta, tour_lengths, optimal_tour_lengths):
+        '''
+        Pickles the history on the background thread. Copies are handed over,
+        so training can keep appending to the lists in the meantime.
+        '''
+        self.wait_for_save()
+        self.save_future = self.save_pool.submit(
+            self.save_history, dict(meta), list(tour_lengths), list(optimal_tour_lengths))
+
+    def wait_for_save(self):
+        if self.save_future is not None:
+            self.save_future.result()
+            self.save_future = None
@@ -1,22 +1,62 @@
-import copy
 import pickle
 import random
 from itertools import combinations
-from random import choice, choices
+from random import choice
 
 import cirq
 import sympy
 import tensorflow  as tf
 import tensorflow_quantum as tfq
 import numpy as np
+from numba import njit
 
 from config import BASE_PATH
-from src.utils.analytic_exp_vals import compute_analytic_expectation
-from src.utils.helpers import compute_tour_length
+from src.utils.helpers import compute_distance_matrix, compute_tour_length_from_distances
 from src.model.circuits import graph_encoding_circuit, hardware_efficient_circuit
 from src.model.layers import TrainableRescaling, ScalableDataReuploadingController, EquivariantLayer
-from src.model.q_learning import QLearning, CircuitType
-from collections import namedtuple
+from src.model.q_learning import QLearning, CircuitType, ReplayBuffer
+from src.model.tsp_q_learning_analytical import QLearningTspAnalytical # kept importable from here
+from collections import deque
+
+
+@njit(cache=True)
+def _q_vals_kernel(expectations, weights, tour_edges, tour_offsets, edge_to_col):
+    '''
+    Q-value of every possible extension of each partial tour by node i.
+    Nodes already in the tour get a q-value of -10000.
+    '''
+    n_vars = edge_to_col.shape[0]
+    batch_size = len(tour_offsets) - 1
+    q_vals = np.full((batch_size, n_vars), -10000, dtype=np.float32)
+    node_in_tour = np.zeros(n_vars, dtype=np.bool_)
+    for tour_ix in range(batch_size):
+        node_in_tour[:] = False
+        last_node = 0 # no edges yet, the tour starts at node 0
+        for k in range(tour_offsets[tour_ix], tour_offsets[tour_ix + 1]):
+            node_in_tour[tour_edges[k, 0]] = True
+            node_in_tour[tour_edges[k, 1]] = True
+            last_node = tour_edges[k, 1]
+        node_in_tour[last_node] = True
+
+        for i in range(n_vars):
+            if not node_in_tour[i]:
+                # observable for o_vl of the next edge (last_node, i)
+                col = edge_to_col[last_node, i]
+                q_vals[tour_ix, i] = weights[tour_ix, col] * expectations[tour_ix, col]
+    return q_vals
+
+
+@njit(cache=True)
+def _mask_kernel(weights, tour_edges, tour_offsets, edge_to_col):
+    '''
+    Edge weights of the edges in each partial tour, 0 for all other edges.
+    '''
+    masks = np.zeros_like(weights)
+    for tour_ix in range(len(tour_offsets) - 1):
+        for k in range(tour_offsets[tour_ix], tour_offsets[tour_ix + 1]):
+            col = edge_to_col[tour_edges[k, 0], tour_edges[k, 1]]
+            masks[tour_ix, col] = weights[tour_ix, col]
+    return masks
 
 
 class QLearningTsp(QLearning):
@@ -29,29 +69,76 @@ class QLearningTsp(QLearning):
             path=BASE_PATH):
 
         super(QLearningTsp, self).__init__(hyperparams, save, save_as, test, path)
+
+        self.optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate, amsgrad=True)
+        self.optimizer_output = tf.keras.optimizers.Adam(learning_rate=self.learning_rate_out)
+        self.optimizer_input = tf.keras.optimizers.Adam(learning_rate=self.learning_rate_in)
+
+        self.optimizers = []
+        self.w_idx = []
+
+        if self.circuit_type == CircuitType.HWE:
+            self.optimizers = [self.optimizer]
+            self.w_idx = [0]
+
+        if self.trainable_scaling:
+            self.optimizers.append(self.optimizer_input)
+            self.w_idx.append(self.optimizers.index(self.optimizer_input))
+
+        if self.trainable_obs_weight:
+            self.optimizers.append(self.optimizer_output)
+            self.w_idx.append(self.optimizers.index(self.optimizer_output))
+
+        self.loss_fun = tf.keras.losses.mse
         
         # Qubits are fully connected to each other.
         self.fully_connected_qubits = list(combinations(list(range(self.n_vars)), 2))
+        self.fully_connected_qubits_arr = np.asarray(self.fully_connected_qubits)
+        # Column of edge (i, j) in the readout / edge weight arrays. Symmetric,
+        # so (j, i) looks up the same column.
+        self.edge_to_col = np.full((self.n_vars, self.n_vars), -1, dtype=np.int32)
+        cols = np.arange(len(self.fully_connected_qubits), dtype=np.int32)
+        self.edge_to_col[self.fully_connected_qubits_arr[:, 0], self.fully_connected_qubits_arr[:, 1]] = cols
+        self.edge_to_col[self.fully_connected_qubits_arr[:, 1], self.fully_connected_qubits_arr[:, 0]] = cols
+        # compile the numba kernels once up front
+        num_edges_in_graph = len(self.fully_connected_qubits)
+        dummy_values = np.zeros((1, num_edges_in_graph), dtype=np.float32)
+        self.q_vals_from_expectations([[(0, 1)]], dummy_values, tf.constant(dummy_values))
+        self.get_masks_for_actions(dummy_values, [[(0, 1)]])
         
         # Returns qubits in a grid of 1 row, and self.n_vars columns
         self.qubits = cirq.GridQubit.rect(1, self.n_vars)
         self.is_multi_instance = hyperparams.get('is_multi_instance')
         self.readout_op = self.initialize_readout()
-        self.interaction = namedtuple(
-            'interaction', ('state', 'action', 'reward', 'next_state', 'done', 'partial_tour', 'edge_weights'))
         self.model, self.target_model = self.initialize_models()
         self.data_path = hyperparams.get('data_path')
+        # The models only read their input state from the data tensor, the
+        # quantum state input is always the empty circuit.
+        self.empty_circuit = tfq.convert_to_tensor([cirq.Circuit()])
+        self.empty_circuit_batch = tfq.convert_to_tensor([cirq.Circuit()] * self.batch_size)
+        num_edges_in_graph = len(self.fully_connected_qubits)
+        self.predict_graph = tf.function(self._predict_graph, input_signature=[
+            tf.TensorSpec(shape=(None, self.n_vars + num_edges_in_graph), dtype=tf.float32)]) # states
+        self.train_graph = tf.function(self._train_graph, input_signature=[
+            tf.TensorSpec(shape=(None, self.n_vars + num_edges_in_graph), dtype=tf.float32), # states
+            tf.TensorSpec(shape=(None,), dtype=tf.float32), # target q-values
+            tf.TensorSpec(shape=(None, num_edges_in_graph), dtype=tf.float32)]) # action masks
+
+    def initialize_memory(self):
+        num_edges_in_graph = self.n_vars * (self.n_vars - 1) // 2
+        n_input_params = self.n_vars + num_edges_in_graph
+        return ReplayBuffer(self.memory_length, {
+            'state': ((n_input_params,), np.float32),
+            'action': ((), np.int32),
+            'reward': ((), np.float32),
+            'next_state': ((n_input_params,), np.float32),
+            'done': ((), np.float32),
+            'partial_tour': ((), object),
+            'edge_weights': ((num_edges_in_graph,), np.float32)})
 
     def save_data(self, meta, tour_lengths, optimal_tour_lengths):
-        with open(self.path + '{}_meta.pickle'.format(self.save_as), 'wb') as file:
-            pickle.dump(meta, file)
-
-        with open(self.path + '{}_tour_lengths.pickle'.format(self.save_as), 'wb') as file:
-            pickle.dump(tour_lengths, file)
-
-        with open(self.path + '{}_optimal_lengths.pickle'.format(self.save_as), 'wb') as file:
-            pickle.dump(optimal_tour_lengths, file)
-
+        self.save_history_async(meta, tour_lengths, optimal_tour_lengths)
+        # the weights change with every train step, so they are written right away
         self.model.save_weights(self.path + '{}_model.h5'.format(self.save_as))
 
     def initialize_readout(self):
@@ -64,65 +151,53 @@ class QLearningTsp(QLearning):
         
         The list self.fully_connected_qubits is expected to be a list of tuples
         / pairs, where each tuple contains two indices of qubits that are connected.
-        '''
-        readout_ops = []
-        for edge in self.fully_connected_qubits:
-            readout_ops.append(cirq.Z(self.qubits[edge[0]]) * cirq.Z(self.qubits[edge[1]]))
-        return readout_ops
 
-    def generate_neqc_model(self, is_target_model=False):
-        '''
-        Creates a model for the ansatz NEQC
+        The operators are kept separate (rather than one masked PauliSum) since
+        the q-values need every per-edge expectation, and the operators of a
+        ControlledPQC are fixed, so a per-sample mask cannot be folded into them.
+        The Adjoint differentiator already contracts the per-edge downstream
+        gradients into a single backward pass.
         '''
-        name_prefix = ''
-        if is_target_model:
-            name_prefix = 'target_'
+        return [
+            cirq.Z(self.qubits[edge[0]]) * cirq.Z(self.qubits[edge[1]])
+            for edge in self.fully_connected_qubits]
 
-        # edges E
-        num_edges_in_graph = len(self.fully_connected_qubits)
-        # input params (number of qubits + number of edges in graph)
-        n_input_params = self.n_vars + num_edges_in_graph
-        # Number of variational parameters for the model, calculated based on 
-        # the number of qubits, a constant multiplier, and the number of 
-        # predictive layers.
-        '''
-        5 qubits, there are 4 gates, where each gate is between gate i and gate i+1 (for i in [0,3]) --> 1 parameter for each gate
-        '''
-        n_var_params = 15 * (self.n_vars - 1) * self.n_pred_layers
-        '''
-        Number of times data is reuploaded into the quantum circuit.
-        Reuploading refers to feeding classical data into quantum circuits
-        at multiple stages of the circuit to enhance expressivity
-        '''
-        n_data_reps = self.n_layers if self.use_reuploading else 1
-        
+    def generate_data_symbols(self, n_data_reps):
         '''
         Creates symbolic variables using sympy, which represent the 
         classical data inputs that will be fed into the quantum circuit.
         This data is structured in layers, corresponding to either 
-        qubit-specific data or edge-specific data
+        qubit-specific data or edge-specific data.
+
+        Returns the symbols in the nested form expected by the circuit
+        builders ([qubit symbols..., [edge symbols...]] per layer) and their
+        names flattened layer by layer, matching the order of the input data.
         '''
-        data_symbols = [
-            [
-                sympy.Symbol(f'd_{layer}_{qubit}')
-                for qubit in range(len(self.qubits))
-            ] +
-            [
-                [sympy.Symbol(f'd_{layer}_e_{ew}') for ew in range(num_edges_in_graph)]
-            ]
-            for layer in range(n_data_reps)
-        ]
+        num_edges_in_graph = len(self.fully_connected_qubits)
+        qubit_symbols = [
+            [sympy.Symbol(f'd_{layer}_{qubit}') for qubit in range(len(self.qubits))]
+            for layer in range(n_data_reps)]
+        edge_symbols = [
+            [sympy.Symbol(f'd_{layer}_e_{ew}') for ew in range(num_edges_in_graph)]
+            for layer in range(n_data_reps)]
+
+        data_symbols = [qubit_symbols[layer] + [edge_symbols[layer]] for layer in range(n_data_reps)]
+        flattened_data_symbols = [
+            str(symbol) for layer in range(n_data_reps)
+            for symbol in qubit_symbols[layer] + edge_symbols[layer]]
+        return data_symbols, flattened_data_symbols
 
+    def build_model(self, encoding_layer, circuit, is_target_model=False):
         '''
-        Construct the quantum circuit based on the 
-        - number of fully connected qubits,
-        - list of qubits
-        - number of layers in the circuit
-        - symbolic data representations
+        Wraps a parameterized circuit and its encoding layer into a compiled
+        Keras model. Shared by all circuit types.
         '''
-        circuit = graph_encoding_circuit(
-            self.fully_connected_qubits, self.qubits, self.n_layers, data_symbols)
-        
+        name_prefix = ''
+        if is_target_model:
+            name_prefix = 'target_'
+
+        # input params (number of qubits + number of edges in graph)
+        n_input_params = self.n_vars + len(self.fully_connected_qubits)
         '''
         This is a classical input layer expecting a number of input params
         represented as a float32 tensor.
@@ -133,25 +208,6 @@ class QLearningTsp(QLearning):
         '''
         input_q_state = tf.keras.Input(shape=(), dtype=tf.string, name='quantum_state')
         '''
-        The data symbols are flattened into a single list of strings,
-        which are used to parameterize the quantum circuit.
-        '''
-        flattened_data_symbols = []
-        for layer in data_symbols:
-            for item in layer:
-                if type(item) == list:
-                    for symbol in item:
-                        flattened_data_symbols.append(str(symbol))
-                else:
-                    flattened_data_symbols.append(str(item))
-        '''
-        Custom defined.
-        '''
-        encoding_layer = ScalableDataReuploadingController(
-            num_input_params=n_input_params, num_params=n_var_params, circuit_depth=self.n_layers,
-            params=flattened_data_symbols, trainable_scaling=self.trainable_scaling,
-            use_reuploading=self.use_reuploading)
-        '''
         This layer integrates the quantum circuit "circuit" into the TF model.
         The differentiators.Adjoint() is used to compute gradients wrt to 
         quantum circuit parameters. The operators `operators=self.readout_op
@@ -171,7 +227,6 @@ class QLearningTsp(QLearning):
         '''
         Trainable Rescaling
         - adjusts the output of the quantum circuit
-        - adu
         This operation scales the outputs (expectation values)
         before they are passed to the final output layer.
         '''
@@ -200,39 +255,65 @@ class QLearningTsp(QLearning):
 
         return model
 
-    def generate_eqc_model(self, is_target_model=False):
-        name_prefix = ''
-        if is_target_model:
-            name_prefix = 'target_'
+    def generate_neqc_model(self, is_target_model=False):
+        '''
+        Creates a model for the ansatz NEQC
+        '''
+        # edges E
+        num_edges_in_graph = len(self.fully_connected_qubits)
+        # input params (number of qubits + number of edges in graph)
+        n_input_params = self.n_vars + num_edges_in_graph
+        # Number of variational parameters for the model, calculated based on 
+        # the number of qubits, a constant multiplier, and the number of 
+        # predictive layers.
+        '''
+        5 qubits, there are 4 gates, where each gate is between gate i and gate i+1 (for i in [0,3]) --> 1 parameter for each gate
+        '''
+        n_var_params = 15 * (self.n_vars - 1) * self.n_pred_layers
+        '''
+        Number of times data is reuploaded into the quantum circuit.
+        Reuploading refers to feeding classical data into quantum circuits
+        at multiple stages of the circuit to enhance expressivity
+        '''
+        n_data_reps = self.n_layers if self.use_reuploading else 1
+        
+        '''
+        The data symbols are also returned flattened into a single list of
+        strings, which are used to parameterize the quantum circuit.
+        '''
+        data_symbols, flattened_data_symbols = self.generate_data_symbols(n_data_reps)
 
+        '''
+        Construct the quantum circuit based on the 
+        - number of fully connected qubits,
+        - list of qubits
+        - number of layers in the circuit
+        - symbolic data representations
+        '''
+        circuit = graph_encoding_circuit(
+            self.fully_connected_qubits, self.qubits, self.n_layers, data_symbols)
+        '''
+        Custom defined.
+        '''
+        encoding_layer = ScalableDataReuploadingController(
+            num_input_params=n_input_params, num_params=n_var_params, circuit_depth=self.n_layers,
+            params=flattened_data_symbols, trainable_scaling=self.trainable_scaling,
+            use_reuploading=self.use_reuploading)
+
+        return self.build_model(encoding_layer, circuit, is_target_model)
+
+    def generate_eqc_model(self, is_target_model=False):
         num_edges_in_graph = len(self.fully_connected_qubits)
         '''input params = number of qubits + number of graph edges'''
         n_input_params = self.n_vars + num_edges_in_graph
         # Notice this does not have n_var_params variable
-        data_symbols = [
-            [
-                sympy.Symbol(f'd_{layer}_{qubit}')
-                for qubit in range(len(self.qubits))] +
-            [[sympy.Symbol(f'd_{layer}_e_{ew}') for ew in range(num_edges_in_graph)]]
-            for layer in range(self.n_layers)]
+        data_symbols, flattened_data_symbols = self.generate_data_symbols(self.n_layers)
 
         '''
         The quantum circuit here is specifically designed to encode the graph structure in a way that respects the symmetries (equivariances) of the graph
         '''
         circuit = graph_encoding_circuit(
             self.fully_connected_qubits, self.qubits, self.n_layers, data_symbols)
-        
-        input_data = tf.keras.Input(shape=n_input_params, dtype=tf.dtypes.float32, name='input')
-        input_q_state = tf.keras.Input(shape=(), dtype=tf.string, name='quantum_state')
-        
-        flattened_data_symbols = []
-        for layer in data_symbols:
-            for item in layer:
-                if type(item) == list:
-                    for symbol in item:
-                        flattened_data_symbols.append(str(symbol))
-                else:
-                    flattened_data_symbols.append(str(item))
         '''
         The encoding layer is an equivariant layer.
         '''
@@ -240,34 +321,8 @@ class QLearningTsp(QLearning):
             num_input_params=n_input_params, n_vars=self.n_vars,
             n_edges=num_edges_in_graph, circuit_depth=self.n_layers,
             params=flattened_data_symbols)
-        '''Same as NEQC'''
-        expectation_layer = tfq.layers.ControlledPQC(
-            circuit, differentiator=tfq.differentiators.Adjoint(),
-            operators=self.readout_op, name="PQC")
-        '''Same as NEQC'''
-        expectation_values = expectation_layer(
-            [input_q_state, encoding_layer(input_data)])
-        '''Same as NEQC'''
-        output_extension_layer = tf.keras.Sequential([
-            TrainableRescaling(
-                len(self.readout_op),
-                trainable_obs_weight=self.trainable_obs_weight)
-        ])
-        '''Same as NEQC'''
-        output = output_extension_layer(expectation_values)
 
-        model = tf.keras.Model(
-            inputs=[input_q_state, input_data],
-            outputs=output, name=f'{name_prefix}q_model')
-
-        model.compile(
-            optimizer=self.optimizer,
-            loss=tf.keras.losses.mse)
-
-        if self.test:
-            model.summary()
-
-        return model
+        return self.build_model(encoding_layer, circuit, is_target_model)
 
     def generate_hwe_model(self, is_target_model=False):
         '''
@@ -279,10 +334,6 @@ class QLearningTsp(QLearning):
         Same as the HWETE model, but only the single-qubit Y-rotation parameters
         are trained.
         '''
-        name_prefix = ''
-        if is_target_model:
-            name_prefix = 'target_'
-
         num_edges_in_graph = len(self.fully_connected_qubits)
         n_input_params = self.n_vars + num_edges_in_graph
         
@@ -299,45 +350,14 @@ class QLearningTsp(QLearning):
                 sympy.Symbol(f'theta_{layer}_{param}')
                 for param in range(len(self.qubits)*1)]
             for layer in range(self.n_layers)]
-        '''
-        
-        '''
-        data_symbols = [
-            [
-                sympy.Symbol(f'd_{layer}_{qubit}')
-                for qubit in range(len(self.qubits))] +
-            [[sympy.Symbol(f'd_{layer}_e_{ew}') for ew in range(num_edges_in_graph)]]
-            for layer in range(n_data_reps)]
+        data_symbols, flattened_data_symbols = self.generate_data_symbols(n_data_reps)
+        flattened_symbols = [str(symbol) for layer in symbols for symbol in layer]
         '''
         Both NEQC and EQC use more specialized circuits (graph encoding circuits) tailored to the structure of the input data.
         '''
         circuit = hardware_efficient_circuit(
             self.fully_connected_qubits, self.qubits, self.n_layers,
             symbols, data_symbols, use_reuploading=self.use_reuploading)
-
-        input_data = tf.keras.Input(shape=n_input_params, dtype=tf.dtypes.float32, name='input')
-        input_q_state = tf.keras.Input(shape=(), dtype=tf.string, name='quantum_state')
-
-        flattened_data_symbols = []
-        for layer in data_symbols:
-            for item in layer:
-                if type(item) == list:
-                    for symbol in item:
-                        flattened_data_symbols.append(str(symbol))
-                else:
-                    flattened_data_symbols.append(str(item))
-        # print("flattened_data_symbols = ", flattened_data_symbols)
-        
-        flattened_symbols = []
-        for layer_item in symbols:
-            for item in layer_item:
-                if type(item) == list:
-                    for symbol in item:
-                        flattened_symbols.append(str(symbol))
-                else:
-                    flattened_symbols.append(str(item))
-        # print("Flattened symbols = ", flattened_symbols)
-        # print("trainable scaling = ", self.trainable_scaling)
         '''
         The encoding layer is controlling both the classical data reuploading
         and the parameterization of the quantum circuit's trainable parameters.
@@ -346,34 +366,8 @@ class QLearningTsp(QLearning):
             num_input_params=n_input_params, num_params=n_var_params, circuit_depth=self.n_layers,
             params=flattened_data_symbols + flattened_symbols,
             trainable_scaling=self.trainable_scaling, use_reuploading=self.use_reuploading)
-        '''ControlledPQC'''
-        expectation_layer = tfq.layers.ControlledPQC(
-            circuit, differentiator=tfq.differentiators.Adjoint(),
-            operators=self.readout_op, name="PQC")
-        
-        expectation_values = expectation_layer(
-            [input_q_state, encoding_layer(input_data)])
-
-        output_extension_layer = tf.keras.Sequential([
-            TrainableRescaling(
-                len(self.readout_op),
-                trainable_obs_weight=self.trainable_obs_weight)
-        ])
-
-        output = output_extension_layer(expectation_values)
-
-        model = tf.keras.Model(
-            inputs=[input_q_state, input_data],
-            outputs=output, name=f'{name_prefix}q_model')
-
-        model.compile(
-            optimizer=self.optimizer,
-            loss=tf.keras.losses.mse)
-
-        if self.test:
-            model.summary()
 
-        return model
+        return self.build_model(encoding_layer, circuit, is_target_model)
 
     def initialize_models(self):
         model = target_model = None
@@ -381,17 +375,15 @@ class QLearningTsp(QLearning):
         # Behaviour policy != Target Policy
         # Data is sampled under behaviour policy
         # Target model is trained and returned to the user.
-        if self.circuit_type == CircuitType.NEQC:
-            model = self.generate_neqc_model()
-            target_model = self.generate_neqc_model(is_target_model=True)
-            target_model.set_weights(model.get_weights())
-        elif self.circuit_type == CircuitType.EQC:
-            model = self.generate_eqc_model()
-            target_model = self.generate_eqc_model(is_target_model=True)
-            target_model.set_weights(model.get_weights())
-        elif self.circuit_type == CircuitType.HWE:
-            model = self.generate_hwe_model()
-            target_model = self.generate_hwe_model(is_target_model=True)
+        generate_model = {
+            CircuitType.NEQC: self.generate_neqc_model,
+            CircuitType.EQC: self.generate_eqc_model,
+            CircuitType.HWE: self.generate_hwe_model,
+        }.get(self.circuit_type)
+
+        if generate_model is not None:
+            model = generate_model()
+            target_model = generate_model(is_target_model=True)
             target_model.set_weights(model.get_weights())
 
         if self.test:
@@ -400,239 +392,138 @@ class QLearningTsp(QLearning):
         return model, target_model
 
     @staticmethod
-    def graph_to_list(
-            nodes, fully_connected_edges, edge_weights, available_nodes, node_to_qubit_map):
+    def graph_to_list(edge_feat, available_mask):
+        '''
+        edge_feat: arctan of the edge weights, in the order of the graph edges.
+        available_mask: boolean array, True for the nodes not yet in the tour.
+        Node i is encoded on qubit i.
+        '''
+        # The encoded value of a node is either 0 (unavailable) or pi (available)
+        node_feat = available_mask * np.pi
+        return np.concatenate([node_feat, edge_feat])
+
+    @staticmethod
+    def flatten_partial_tours(partial_tours):
         '''
-        edge_weights: dictionary of two connected edges.
-        list of nodes in the graph
+        Concatenates the edges of all partial tours into one (total_edges, 2)
+        array. The edges of tour b are tour_edges[tour_offsets[b]:tour_offsets[b+1]].
         '''
-        vals = []
-        # int(node_to_qubit_map[node] in available nodes)
-        #   if qubit is available returns 1.
-        #   otherwise returns 0
-        # Hence, the encoded value is either 0 (unavailable) or pi (available)
-        for node in nodes:
-            vals.append(int(node_to_qubit_map[node] in available_nodes) * np.pi)
-        # Takes the arc_tan of the edge weight.
-        # May be mapping to a different scale. 
-        # This is a montonically increasing function
-        for edge in fully_connected_edges:
-            vals.append(np.arctan(edge_weights[edge]))
-        # print("state = ", vals)
-        return vals
+        tour_offsets = np.zeros(len(partial_tours) + 1, dtype=np.int64)
+        np.cumsum([len(partial_tour) for partial_tour in partial_tours], out=tour_offsets[1:])
+        tour_edges = np.asarray(
+            [edge for partial_tour in partial_tours for edge in partial_tour], dtype=np.int64).reshape(-1, 2)
+        return tour_edges, tour_offsets
 
     def q_vals_from_expectations(self, partial_tours, edge_weights, expectations):
-        # print("q-vals from expectations!")
-        # print("partial_tours = ", partial_tours)
-        # print("edge weights = ", edge_weights)
-        # print("expectations =", expectations)
-        # print("*"*20)
-        # input()
+        '''
+        edge_weights: per tour, an array of the edge weights in the order of
+        self.fully_connected_qubits.
+        '''
         expectations = expectations.numpy() # get numpy from tensor
-        # print("expectations = ", expectations, expectations.shape)
-        # print("partial_tours = ", partial_tours)
-        indexed_expectations = []
-        # separate the expectations according to batch
-        # the zero-th dimension of the expectation corresponds to the batch dimension.
-        for exps in expectations:
-            batch_ix_exp = {}
-            for edge, exp_val in zip(self.fully_connected_qubits, exps):
-                batch_ix_exp[edge] = exp_val
-            indexed_expectations.append(batch_ix_exp)
-        
-        batch_q_vals = []
-        for tour_ix, partial_tour in enumerate(partial_tours):
-            q_vals = []
-            # Consider every possible extnsion of the partial tour by checking that
-            # node i is part of the tour.
-            # If i can be found on any edge, set the qval of the next edge being i to be -10000 
-            # partial_tour = [0,1,5]
-            # [1,4]
-            for i in range(self.n_vars): # i = 0, 1, 2,3, 4, 5
-                node_in_tour = False
-                for edge in partial_tour: # 
-                    if i in edge:
-                        node_in_tour = True
-                # If node is in partial tour,
-                if not node_in_tour:
-                    next_edge = None
-                    if partial_tour: # already has some edges
-                        next_edge = (partial_tour[-1][1], i)
-                    else: # no edges yet
-                        if i > 0:
-                            next_edge = (0, i)
-
-                    if next_edge is not None:
-                        # observable for o_vl
-                        try:
-                            q_val = edge_weights[tour_ix][next_edge] * indexed_expectations[tour_ix][next_edge]
-                        except KeyError:
-                            q_val = edge_weights[tour_ix][
-                                (next_edge[1], next_edge[0])] * indexed_expectations[tour_ix][
-                                        (next_edge[1], next_edge[0])]
-                    else:
-                        q_val = -10000 # no valid next edge
-                else:
-                    q_val = -10000 # node already selected (large negative reward)
-                q_vals.append(q_val)
-            # print("q_vals = ", q_vals, len(q_vals))
-            batch_q_vals.append(q_vals)
-        # print("batch_q_vals shape =",  len(batch_q_vals))
-        # print("*"*20)
-        # input()
-        return np.asarray(batch_q_vals)
-
-    def get_action(self, state_tensor, available_nodes, partial_tour, edge_weights):
-        # print("get_action!")
-        # print("state_tensor = ", state_tensor)
-        #epsilon greedy
-        if np.random.uniform() < self.epsilon:
-            # print("random!")
-            action = choice(available_nodes) # select random action
-        else:
-            # print("selecting max qval")
-            state_tensor = tf.convert_to_tensor(state_tensor)
-            state_tensor = tf.expand_dims(state_tensor, 0)
-            expectations = self.model([tfq.convert_to_tensor([cirq.Circuit()]), state_tensor])
-            q_vals = self.q_vals_from_expectations([partial_tour], [edge_weights], expectations)[0]
-            action = np.argmax(q_vals) # select best valued action
-        # print("get_action: ", action)
-        # input()
-        # print("*"*10)
-        return action
+        tour_edges, tour_offsets = self.flatten_partial_tours(partial_tours)
+        return _q_vals_kernel(
+            expectations, np.stack(edge_weights), tour_edges, tour_offsets, self.edge_to_col)
 
-    @staticmethod
-    def get_masks_for_actions(edge_weights, partial_tours):
-        # print("get_masks_for_Action")
-        batch_masks = []
-        for tour_ix, partial_tour in enumerate(partial_tours):
-            mask = []
-            # if edge in tour, append the weight
-            # if edge not in tour, append 0
-            # mask for those edges currently in the tour.
-            for edge, weight in edge_weights[tour_ix].items():
-                if edge in partial_tour or (edge[1], edge[0]) in partial_tour:
-                    mask.append(weight)
-                else:
-                    mask.append(0)
+    def get_action(self, state_tensor, available_mask, partial_tour, edge_weights):
+        # a (1, n_input_params) view of the state, no copy for float32 arrays
+        state_tensors = np.asarray(state_tensor, dtype=np.float32)[None, :]
+        return self.get_actions(state_tensors, [available_mask], [partial_tour], [edge_weights])[0]
 
-            batch_masks.append(mask)
-            # if tour_ix == 0 or tour_ix == 5:
-            #     print("tour_ix = ", tour_ix)
-            #     print("partial_tours = ", partial_tours[tour_ix])
-            #     print("mask =", mask)
-        # print("*"*10)
-        return np.asarray(batch_masks)
+    def get_actions(self, state_tensors, available_masks, partial_tours, edge_weights):
+        '''
+        Epsilon-greedy actions for a batch of tours. The states of all tours
+        that act greedily are evaluated in a single model call.
+        '''
+        actions = [None] * len(state_tensors)
+        greedy = []
+        for tour_ix, explore in enumerate(np.random.uniform(size=len(state_tensors)) < self.epsilon):
+            if explore:
+                actions[tour_ix] = int(choice(np.flatnonzero(available_masks[tour_ix]))) # select random action
+            else:
+                greedy.append(tour_ix)
+
+        if greedy:
+            states = np.asarray(state_tensors, dtype=np.float32)
+            if len(greedy) < len(states):
+                states = states[greedy]
+            expectations = self.predict_graph(states)
+            q_vals = self.q_vals_from_expectations(
+                [partial_tours[ix] for ix in greedy], [edge_weights[ix] for ix in greedy], expectations)
+            for tour_ix, action in zip(greedy, np.argmax(q_vals, axis=1)):
+                actions[tour_ix] = action # select best valued action
+        return actions
+
+    def get_masks_for_actions(self, edge_weights, partial_tours):
+        tour_edges, tour_offsets = self.flatten_partial_tours(partial_tours)
+        return _mask_kernel(np.stack(edge_weights), tour_edges, tour_offsets, self.edge_to_col)
 
     @staticmethod
-    def cost(nodes, tour):
-        return -compute_tour_length(nodes, tour)
+    def cost(distances, tour):
+        return -compute_tour_length_from_distances(distances, tour)
 
-    def compute_reward(self, nodes, old_state, state):
-        return self.cost(nodes, state) - self.cost(nodes, old_state)
+    def compute_reward(self, distances, old_state, state):
+        return self.cost(distances, state) - self.cost(distances, old_state)
 
     def train_step(self):
-        training_batch = choices(self.memory, k=self.batch_size)
-        # print("Original batch = ", training_batch)
-        training_batch = self.interaction(*zip(*training_batch))
-        # print("Batch after = ", training_batch)
-        # print("*"*20)
-        # input()
-        states = [x for x in training_batch.state]
-        rewards = np.asarray([x for x in training_batch.reward], dtype=np.float32)
-        next_states = [x for x in training_batch.next_state]
-        done = np.asarray([x for x in training_batch.done])
-        partial_tours = [x for x in training_batch.partial_tour]
-        edge_weights = [x for x in training_batch.edge_weights]
-
-        states = tf.convert_to_tensor(states)
-        rewards = tf.convert_to_tensor(rewards, dtype=tf.float64)
-        next_states = tf.convert_to_tensor(next_states)
-        done = tf.convert_to_tensor(done, dtype=tf.float64)
-        # print("states = ", states, states.shape)
-        # print("rewards = ", rewards, rewards.shape)
-        # print("next state = ", next_states, next_states.shape)
-        # print("done = ", done, done.shape)
-        
-        # input("***"*8)
+        training_batch = self.memory.sample(self.batch_size)
+        states = training_batch.state
+        next_states = training_batch.next_state
+        partial_tours = training_batch.partial_tour
+        edge_weights = training_batch.edge_weights
+
+        rewards = training_batch.reward
+        done = training_batch.done
+
         # uses the model to predict the expectations ("exp_values_future") for 
         # the next_states qval
-        print("next_states = ", next_states)
-        input()
-        exp_values_future = self.model([tfq.convert_to_tensor([cirq.Circuit()] * self.batch_size), next_states])
-        
-        print(exp_values_future, exp_values_future.shape)
-        input()
-        future_rewards = tf.convert_to_tensor(self.q_vals_from_expectations(
-            partial_tours, edge_weights, exp_values_future), dtype=tf.float64)
-        
-        print(future_rewards, future_rewards.shape)
-        input()
+        exp_values_future = self.predict_graph(next_states)
+        future_rewards = self.q_vals_from_expectations(
+            partial_tours, edge_weights, exp_values_future)
+
         # done is a flag = will be set to 1 the episode is complete, and future
         # rewards is not considered.
+        # Everything stays float32, like the model outputs.
         target_q_values = rewards + (
-                self.gamma * tf.reduce_max(future_rewards, axis=1) * (1.0 - done))
-        print(target_q_values, target_q_values.shape)
-        input()
-        # print("exp_values_future = ", exp_values_future, exp_values_future.shape)
-        # print("future rewards = ", future_rewards, future_rewards.shape)
-        # print("target q values =", target_q_values, target_q_values.shape)
-        
-        # input("***" * 8)
-        # print("target_Q_va")
+                np.float32(self.gamma) * future_rewards.max(axis=1) * (1 - done))
+
+        exp_val_masks = self.get_masks_for_actions(edge_weights, partial_tours)
+        loss = self.train_graph(states, target_q_values, exp_val_masks)
+
+        if self.test:
+            print("loss = ", loss)
+
+        return loss.numpy()
+
+    def _predict_graph(self, states):
+        '''
+        Expectation values of the readout operators for a batch of states.
+        Traced once into self.predict_graph, see __init__.
+        '''
+        return self.model([tf.tile(self.empty_circuit, [tf.shape(states)[0]]), states])
+
+    def _train_graph(self, states, target_q_values, exp_val_masks):
+        '''
+        Gradient step on the masked Q-values of the sampled actions.
+        Traced once into self.train_graph, see __init__.
+        '''
         # record operations for automatic differentiation
         # which allows calculations of gradients with respect to the model's
         # tunable variables
         with tf.GradientTape() as tape:
             tape.watch(self.model.trainable_variables)
-            exp_values = self.model([tfq.convert_to_tensor([cirq.Circuit()]*self.batch_size), states])
-            # print("states = ", states)
-            # print("exp values = ", exp_values[0], exp_values.shape)
-            exp_val_masks = self.get_masks_for_actions(edge_weights, partial_tours)
-            tmp = tf.multiply(exp_values, exp_val_masks)
-            # print("exp val masks = ", exp_val_masks, exp_val_masks.shape)
-            # print("masked expectations = ", tmp)
-            q_values_masked = tf.reduce_sum(tf.multiply(exp_values, exp_val_masks), axis=1)
-            # print("q_values_shape ", q_values_masked.shape)
-            
+            exp_values = self.model([self.empty_circuit_batch, states])
+            # multiply and sum over the edges in one op
+            q_values_masked = tf.einsum('be,be->b', exp_values, tf.cast(exp_val_masks, exp_values.dtype))
+
             loss = self.loss_fun(target_q_values, q_values_masked) # MSE
-            k = 0
-            # for i in range(self.n_vars-1):
-            #     for j in range(i+1, self.n_vars):
-            #         self.exp_vals[i, j].append(tf.reduce_sum(exp_values[:, k]).numpy())
-            #         self.q_vals[i, j].append(tf.reduce_sum(tmp[:, k]).numpy())
-            #         k+=1
-            # print("ep = ", ep)
-            print("loss = ", loss)
-            
-            
-            # print("one example:")
-            # idx = 0
-            # print("idx = ", idx)
-            # print("states[idx] = ", states[idx])
-            # print("exp_values[idx] = ", exp_values[idx])
-            # print("exp_val_masks[idx] = ", exp_val_masks[idx])
-            # print("q_values_masked[idx] = ", q_values_masked[idx])
-            # idx = 1
-            # print("*"*10)
-            # print("idx = ", idx)
-            # print("states[idx] = ", states[idx])
-            # print("exp_values[idx] = ", exp_values[idx])
-            # print("exp_val_masks[idx] = ", exp_val_masks[idx])
-            # print("q_values_masked[idx] = ", q_values_masked[idx])
-            
+
         grads = tape.gradient(loss, self.model.trainable_variables)
-        # print("number of optimizers = ", len(self.optimizers))
-        # print("optimizers = ", self.optimizers)
-        # print("grads = ", grads, len(grads))
         if len(self.optimizers) == 1:
             self.optimizers[0].apply_gradients(zip(grads, self.model.trainable_weights))
         else:
             for optimizer, w in zip(self.optimizers, self.w_idx):
                 optimizer.apply_gradients([(grads[w], self.model.trainable_variables[w])])
-        # print("*"*20)
-        # input()
-        return loss.numpy()
+        return loss
 
     def perform_episodes(self, num_instances):
         # sets up metadata.
@@ -663,7 +554,9 @@ class QLearningTsp(QLearning):
 
         tour_length_history = []
         optimal_tour_length_history = []
-        ratio_history = []
+        # ratios of the 100 most recent episodes and their sum
+        ratio_window = deque(maxlen=100)
+        window_sum = 0.
         running_avgs = []
         running_avg = 0
 
@@ -671,99 +564,78 @@ class QLearningTsp(QLearning):
             instance_number = random.randint(0, num_instances-1)
             # instance_number = 0
             tsp_graph_nodes = x_train[instance_number]
-            optimal_tour_length = compute_tour_length(
-                tsp_graph_nodes, # if start node != end 
+            # euclidean distances between all nodes, used for edge weights and tour lengths
+            distances = compute_distance_matrix(tsp_graph_nodes)
+            optimal_tour_length = compute_tour_length_from_distances(
+                distances, # if start node != end 
                 [int(x - 1) for x in y_train[instance_number][:-1]] # list of nodes denoting a partial tour (initial solution)
             )
-            node_to_qubit_map = {}
-            for i, node in enumerate(tsp_graph_nodes):
-                node_to_qubit_map[node] = i # so number of nodes == number of qubits.
-            
-            fully_connected_edges = []
-            edge_weights = {}
-            edge_weights_ix = {}
-            # print("self.fully_connected_qubits = ", self.fully_connected_qubits)
-            # print("tsp_graph_nodes = ", tsp_graph_nodes)
-            # input()
-            for edge in self.fully_connected_qubits:
-                fully_connected_edges.append((tsp_graph_nodes[edge[0]], tsp_graph_nodes[edge[1]]))
-                edge_distance = np.linalg.norm(
-                    np.asarray(tsp_graph_nodes[edge[0]]) - np.asarray(tsp_graph_nodes[edge[1]])) # euclidean distance
-                edge_weights[(tsp_graph_nodes[edge[0]], tsp_graph_nodes[edge[1]])] = edge_distance 
-                edge_weights_ix[edge] = edge_distance
-            # print("edge_weights = ", edge_weights)
-            # print("edge weights ix = ", edge_weights_ix)
             
+            edge_distances = distances[
+                self.fully_connected_qubits_arr[:, 0], self.fully_connected_qubits_arr[:, 1]]
+            edge_weights = edge_distances.astype(np.float32)
+            # Takes the arc_tan of the edge weight.
+            # May be mapping to a different scale. 
+            # This is a montonically increasing function
+            edge_feat = np.arctan(edge_distances) # constant during the episode
+
             tour = [0]  # w.l.o.g. we always start at city 0
             tour_edges = []
             step_rewards = []
-            available_nodes = list(range(1, self.n_vars)) # all nodes except starting is available.
-            state_list = self.graph_to_list(
-                tsp_graph_nodes, fully_connected_edges, edge_weights,
-                available_nodes, node_to_qubit_map)
-            
-            print(f"episode {episode} " + "*"*10)
-            # print("edge_weights = ", edge_weights)
-            # print("edge weights ix = ", edge_weights_ix)
-            state_tensor = tf.convert_to_tensor(state_list)
-            state_tensor = tf.expand_dims(state_tensor, 0)
-            exp = self.model([tfq.convert_to_tensor([cirq.Circuit()]), state_tensor])
-            exp = exp.numpy()
+            available_mask = np.ones(self.n_vars, dtype=bool)
+            available_mask[0] = False # all nodes except starting is available.
+            # Only the availability entry of the selected node changes per
+            # step, so the state is built once and updated in place.
+            state_arr = np.asarray(self.graph_to_list(edge_feat, available_mask), dtype=np.float32)
             
-            # assert exp.shape == (1, 10), f"wrong = exp.shape is {exp.shape}"
-            # k = 0
-            # for i in range(self.n_vars - 1):
-            #     for j in range(i+1, self.n_vars):
-            #         self.exp_vals[i, j].append(exp[0,k])
-            #         k += 1
-            # self.exp_vals['x'].append(episode)
+            if self.test:
+                print(f"episode {episode} " + "*"*10)
+
             # Constructs the tour
             for i in range(self.n_vars):
-                prev_tour = copy.deepcopy(tour)
-                state_list = self.graph_to_list(
-                    tsp_graph_nodes, fully_connected_edges, edge_weights,
-                    available_nodes, node_to_qubit_map)
-                # input()
+                prev_tour = tour[:]
+                state_list = state_arr.copy()
                 ## step through the episode
-                next_node = self.get_action(state_list, available_nodes, tour_edges, edge_weights_ix)
+                next_node = self.get_action(state_list, available_mask, tour_edges, edge_weights)
                 # add to tour edges / tour
                 tour_edges.append((tour[-1], next_node))
-                new_tour_edges = copy.deepcopy(tour_edges)
+                new_tour_edges = tour_edges[:]
                 tour.append(next_node)
                 # remove selected node from the available nodes.
-                remove_node_ix = available_nodes.index(next_node)
-                del available_nodes[remove_node_ix]
+                available_mask[next_node] = False
+                n_available = np.count_nonzero(available_mask)
+                state_arr[next_node] = 0. # node is no longer available
+                next_state_list = state_arr.copy()
 
                 if len(tour) > 1:
-                    reward = self.compute_reward(tsp_graph_nodes, prev_tour, tour)
+                    reward = self.compute_reward(distances, prev_tour, tour)
                     step_rewards.append(reward)
                     
-                    done = 0 if len(available_nodes) > 1 else 1 # only true when the tour consists of n nodes.
-                    transition = (state_list, next_node, reward, self.graph_to_list(
-                        tsp_graph_nodes, fully_connected_edges, edge_weights,
-                        available_nodes, node_to_qubit_map), done, new_tour_edges, edge_weights_ix) # state, next_node, reward, new state 
+                    done = 0 if n_available > 1 else 1 # only true when the tour consists of n nodes.
+                    transition = (
+                        state_list, next_node, reward, next_state_list,
+                        done, new_tour_edges, edge_weights) # state, next_node, reward, new state 
                     self.memory.append(transition) # save to buffer
 
-                if len(available_nodes) == 1:
-                    prev_tour = copy.deepcopy(tour) 
+                if n_available == 1:
+                    prev_tour = tour[:]
                     # complete the tour
-                    tour_edges.append((tour[-1], available_nodes[0]))
-                    tour_edges.append((available_nodes[0], tour[0]))
-                    new_tour_edges = copy.deepcopy(tour_edges)
-                    tour.append(available_nodes[0])
+                    last_node = int(np.flatnonzero(available_mask)[0])
+                    tour_edges.append((tour[-1], last_node))
+                    tour_edges.append((last_node, tour[0]))
+                    new_tour_edges = tour_edges[:]
+                    tour.append(last_node)
                     tour.append(tour[0])
-                    reward = self.compute_reward(tsp_graph_nodes, prev_tour, tour)
+                    reward = self.compute_reward(distances, prev_tour, tour)
                     step_rewards.append(reward)
 
-                    transition = (state_list, next_node, reward, self.graph_to_list(
-                        tsp_graph_nodes, fully_connected_edges, edge_weights,
-                        available_nodes, node_to_qubit_map), 
+                    transition = (state_list, next_node, reward, next_state_list,
                     1, #done
-                    new_tour_edges, edge_weights_ix)
+                    new_tour_edges, edge_weights)
                     self.memory.append(transition)
                     break
 
-            tour_length = compute_tour_length(tsp_graph_nodes, tour)
+            tour_length = compute_tour_length_from_distances(distances, tour)
             tour_length_history.append(tour_length)
             optimal_tour_length_history.append(optimal_tour_length)
             
@@ -793,27 +665,30 @@ class QLearningTsp(QLearning):
             if self.epsilon_schedule == 'fast':
                 self.epsilon = max(self.epsilon_min, self.epsilon_decay * self.epsilon)
 
-            if self.save:
+            if self.save and episode % self.save_after == 0:
                 self.save_data(self.meta, tour_length_history, optimal_tour_length_history)
             # find approximation ratio
-            ratio_history.append(tour_length_history[-1] / optimal_tour_length)
-
-            if len(ratio_history) >= 100:
-                running_avg = np.mean(ratio_history[-100:])
-            else:
-                running_avg = np.mean(ratio_history)
+            ratio = tour_length_history[-1] / optimal_tour_length
+            if len(ratio_window) == ratio_window.maxlen:
+                window_sum -= ratio_window[0] # drops out of the window on append
+            ratio_window.append(ratio)
+            window_sum += ratio
+            running_avg = window_sum / len(ratio_window)
             # maintain a running avg of the 100 most recent episodes
             running_avgs.append(running_avg)
             
-            if len(ratio_history) >= 100 and running_avg <= 1.25:
+            if len(ratio_window) >= 100 and running_avg <= 1.25:
                 print(f"Environment solved in {episode+1} episodes!")
                 self.meta['env_solved'] = True
-                if self.save:
-                    self.save_data(self.meta, tour_length_history, optimal_tour_length_history)
                 break
             
             
             
+        if self.save:
+            # final state of the run, including episodes since the last periodic save
+            self.save_data(self.meta, tour_length_history, optimal_tour_length_history)
+            self.wait_for_save()
+
         if self.test:
             import matplotlib.pyplot as plt
             plt.plot(running_avgs)
@@ -909,304 +784,6 @@ class QLearningTsp(QLearning):
             print("instance = ", x_train[0])
             print("optimal tour = ", [int(x-1) for x in y_train[0]])
 
-class QLearningTspAnalytical(QLearning):
-    def __init__(
-            self,
-            hyperparams,
-            save=True,
-            save_as=None,
-            test=False,
-            path=BASE_PATH):
-
-        super(QLearningTspAnalytical, self).__init__(hyperparams, save, save_as, test, path)
-
-        self.interaction = namedtuple(
-            'interaction', ('state', 'action', 'reward', 'next_state', 'done', 'partial_tour', 'edge_weights'))
-        self.data_path = hyperparams.get('data_path')
-
-        self.epsilon_fd = 0.005  # epsilon for finite difference gradient
-
-        # Adam hyperparams
-        self.t = {}
-        self.m_t = {}
-        self.v_t = {}
-        self.beta_1 = 0.9
-        self.beta_2 = 0.999
-
-        self.params = [1.1, 1]
-        self.target_params = [1.1, 1]
-        self.fully_connected_edges = list(combinations(list(range(self.n_vars)), 2)) # complete graph  of N vertices
-
-    def save_data(self, meta, tour_lengths, optimal_tour_lengths):
-        with open(self.path + '{}_meta.pickle'.format(self.save_as), 'wb') as file:
-            pickle.dump(meta, file)
-
-        with open(self.path + '{}_tour_lengths.pickle'.format(self.save_as), 'wb') as file:
-            pickle.dump(tour_lengths, file)
-
-        with open(self.path + '{}_optimal_lengths.pickle'.format(self.save_as), 'wb') as file:
-            pickle.dump(optimal_tour_lengths, file)
-
-        with open(self.path + '{}_params.pickle'.format(self.save_as), 'wb') as file:
-            pickle.dump(self.params, file)
-
-    def q_vals_from_expectations(self, partial_tours, edge_weights, params):
-        batch_q_vals = []
-        for tour_ix, partial_tour in enumerate(partial_tours):
-            q_vals = []
-            for i in range(self.n_vars):
-                node_in_tour = False
-                for edge in partial_tour:
-                    if i in edge:
-                        node_in_tour = True
-
-                if not node_in_tour:
-                    next_edge = None
-                    if partial_tour:
-                        next_edge = (partial_tour[-1][1], i)
-                    else:
-                        if i > 0:
-                            next_edge = (0, i)
-
-                    if next_edge is not None:
-                        try:
-                            weight = edge_weights[tour_ix][next_edge]
-                        except KeyError:
-                            weight = edge_weights[tour_ix][
-                                (next_edge[1], next_edge[0])]
-                        # only this part is different!
-                        q_val = weight * compute_analytic_expectation(
-                            params[0], params[1], next_edge[0], next_edge[1],
-                            self.n_vars, edge_weights[tour_ix], available_node='j')
-                    else:
-                        q_val = -10000
-                else:
-                    q_val = -10000
-                q_vals.append(q_val)
-
-            batch_q_vals.append(q_vals)
-
-        return np.asarray(batch_q_vals)
-
-    def get_action(self, available_nodes, partial_tour, edge_weights):
-        # Note: in this signature, there is no state tensor.
-        if np.random.uniform() < self.epsilon:
-            action = choice(available_nodes)
-        else:
-            q_vals = self.q_vals_from_expectations(
-                [partial_tour], [edge_weights], self.params)[0]
-            action = np.argmax(q_vals)
-
-        return action
-
-    @staticmethod
-    def cost(nodes, tour):
-        return -compute_tour_length(nodes, tour)
-
-    def compute_reward(self, nodes, old_state, state):
-        return self.cost(nodes, state) - self.cost(nodes, old_state)
-
-    def compute_fd_loss_gradient(self, states):
-        '''
-        Computes the gradient of the loss function w.r.t. to the parameters of the model using finite differences.
-        
-        Finite difference is used to approximate the derivative of a function
-        when the analytical derivative is difficult to obtain.
-        
-        The method specifically calculates how the loss function changes w.r.t
-        to small changes in the parameters of the model (self.params)
-        '''
-        batch_gradients = {0: [], 1: []}
-        loss_vals = []
-        for partial_tour, edge_weights, action, target_q_value in states:
-            q_vals = self.q_vals_from_expectations([partial_tour], [edge_weights], self.params)[0]
-            loss = abs(target_q_value - [q_vals[action]])**2 # squared error
-            loss_vals.append(loss)
-            for i, params in enumerate(self.params):
-                shifted_params = copy.deepcopy(self.params)
-                shifted_params[i] += self.epsilon_fd
-                q_vals_shifted = self.q_vals_from_expectations([partial_tour], [edge_weights], shifted_params)[0] 
-                derivative = (abs(target_q_value - [q_vals_shifted[action]]) - loss) / self.epsilon_fd # wait they forgot the square **2 in the shifted params
-                batch_gradients[i].append(derivative.numpy()[0])
-
-        gradient = {0: np.mean(batch_gradients[0]), 1: np.mean(batch_gradients[1])}
-        return gradient, np.mean(loss_vals)
-
-    def train_step(self):
-        training_batch = choices(self.memory, k=self.batch_size)
-        training_batch = self.interaction(*zip(*training_batch))
-
-        actions = [x for x in training_batch.action]
-        rewards = np.asarray([x for x in training_batch.reward], dtype=np.float32)
-        done = np.asarray([x for x in training_batch.done])
-        partial_tours = [x for x in training_batch.partial_tour]
-        edge_weights = [x for x in training_batch.edge_weights]
-
-        future_q_vals_all = self.q_vals_from_expectations(
-            partial_tours, edge_weights, self.target_params)
-        future_q_vals = []
-        for i, q_vals in enumerate(future_q_vals_all):
-            future_q_vals.append(q_vals[actions[i]])
-        future_q_vals = np.asarray(future_q_vals)
-        target_q_values = rewards + (
-                self.gamma * tf.reduce_max(future_q_vals, axis=0) * (1.0 - done))
-
-        gradient, loss = self.compute_fd_loss_gradient(
-            zip(partial_tours, edge_weights, actions, target_q_values))
-        updated_params = copy.deepcopy(self.params)
-        for param, deriv in gradient.items():
-            self.t[param] = self.t.get(param, 0) + 1
-            # update first moment estimate
-            self.m_t[param] = (self.beta_1 * self.m_t.get(param, 0)) + ((1 - self.beta_1) * deriv)
-            # update second moment estimate
-            self.v_t[param] = (self.beta_2 * self.v_t.get(param, 0)) + ((1 - self.beta_2) * deriv ** 2)
-            # bias correction for first moment estimate
-            m_cap = self.m_t[param] / (1 - self.beta_1 ** self.t[param])
-            # bias correction for second moment estimate
-            v_cap = self.v_t[param] / (1 - self.beta_2 ** self.t[param])
-            # small value to avoid dividing by 0
-            v_temp = np.sqrt(v_cap) + self.epsilon
-            # compute gradient using adaptive learning rate = 1
-            grad = 1 * m_cap / v_temp
-            parameter_update = -1 * self.learning_rate * grad
-            updated_params[param] = updated_params[param] + parameter_update
-
-        self.params = updated_params
-
-        return loss
-
-    def perform_episodes(self, num_instances):
-        self.meta['num_instances'] = num_instances
-        self.meta['best_tour_length'] = 100000
-        self.meta['best_tour'] = []
-        self.meta['best_tour_ix'] = 0
-        self.meta['env_solved'] = False
-
-        with open(self.data_path, 'rb') as file:
-            data = pickle.load(file)
-
-        x_train = data['x_train'][:num_instances]
-        y_train = data['y_train'][:num_instances]
-
-        tour_length_history = []
-        optimal_tour_length_history = []
-        ratio_history = []
-        running_avgs = []
-        running_avg = 0
-
-        for episode in range(self.episodes):
-            instance_number = random.randint(0, num_instances-1)
-            # instance_number = 0
-            tsp_graph_nodes = x_train[instance_number]
-            optimal_tour_length = compute_tour_length(
-                tsp_graph_nodes, [int(x - 1) for x in y_train[instance_number][:-1]])
-            node_to_qubit_map = {}
-            for i, node in enumerate(tsp_graph_nodes):
-                node_to_qubit_map[node] = i
-
-            fully_connected_edges = []
-            edge_weights_ix = {}
-            
-            for edge in self.fully_connected_edges:
-                fully_connected_edges.append((tsp_graph_nodes[edge[0]], tsp_graph_nodes[edge[1]]))
-                edge_distance = np.linalg.norm(
-                    np.asarray(tsp_graph_nodes[edge[0]]) - np.asarray(tsp_graph_nodes[edge[1]])) # euclidean
-                edge_weights_ix[edge] = edge_distance
-
-            tour = [0]  # w.l.o.g. we always start at city 0
-            tour_edges = []
-            step_rewards = []
-            available_nodes = list(range(1, self.n_vars))
-
-            for i in range(self.n_vars):
-                prev_tour = copy.deepcopy(tour)
-                next_node = self.get_action(available_nodes, tour_edges, edge_weights_ix)
-                tour_edges.append((tour[-1], next_node))
-                new_tour_edges = copy.deepcopy(tour_edges)
-                tour.append(next_node)
-
-                remove_node_ix = available_nodes.index(next_node)
-                del available_nodes[remove_node_ix]
-
-                if len(tour) > 1:
-                    reward = self.compute_reward(tsp_graph_nodes, prev_tour, tour)
-                    step_rewards.append(reward)
-
-                    done = 0 if len(available_nodes) > 1 else 1
-                    transition = (
-                        edge_weights_ix, next_node, reward, edge_weights_ix,
-                        done, new_tour_edges, edge_weights_ix
-                    )
-                    self.memory.append(transition)
-
-                if len(available_nodes) == 1:
-                    prev_tour = copy.deepcopy(tour)
-                    tour_edges.append((tour[-1], available_nodes[0]))
-                    tour_edges.append((available_nodes[0], tour[0]))
-                    new_tour_edges = copy.deepcopy(tour_edges)
-                    tour.append(available_nodes[0])
-                    tour.append(tour[0])
-                    reward = self.compute_reward(tsp_graph_nodes, prev_tour, tour)
-                    step_rewards.append(reward)
-
-                    transition = (
-                        edge_weights_ix, next_node, reward, edge_weights_ix, 1,
-                        new_tour_edges, edge_weights_ix)
-                    self.memory.append(transition)
-                    break
-
-            tour_length = compute_tour_length(tsp_graph_nodes, tour)
-            tour_length_history.append(tour_length)
-            optimal_tour_length_history.append(optimal_tour_length)
-
-            if tour_length < self.meta.get('best_tour_length'):
-                self.meta['best_tour_length'] = tour_length
-                self.meta['best_tour'] = tour
-                self.meta['best_tour_ix'] = instance_number
-
-            if len(self.memory) >= self.batch_size:
-                if episode % self.update_after == 0:
-                    loss = self.train_step()
-                    print(
-                        f"Episode {episode}, loss {loss}, running avg {running_avg}, epsilon {self.epsilon}")
-                    print(f"\tFinal tour: {tour}")
-                else:
-                    print(
-                            f"Episode {episode}, running avg {running_avg}, epsilon {self.epsilon}")
-                    print(f"\tFinal tour: {tour}")
-
-                if episode % self.update_target_after == 0:
-                    self.target_params = copy.deepcopy(self.params)
-
-            self.epsilon = max(self.epsilon_min, self.epsilon_decay * self.epsilon)
-
-            if self.save:
-                self.save_data(self.meta, tour_length_history, optimal_tour_length_history)
-
-            ratio_history.append(tour_length_history[-1] / optimal_tour_length)
-
-            if len(ratio_history) >= 100:
-                running_avg = np.mean(ratio_history[-100:])
-            else:
-                running_avg = np.mean(ratio_history)
-
-            running_avgs.append(running_avg)
-
-            if len(ratio_history) >= 100 and running_avg <= 1.02:
-                print(f"Environment solved in {episode+1} episodes!")
-                self.meta['env_solved'] = True
-                if self.save:
-                    self.save_data(self.meta, tour_length_history, optimal_tour_length_history)
-                break
-
-        if self.test:
-            import matplotlib.pyplot as plt
-            plt.plot(running_avgs)
-            plt.ylabel("Ratio to optimal tour length")
-            plt.xlabel("Episode")
-            plt.title("Running average over past 100 episodes")
-            plt.show()
-
 
 def get_tour_from_trained_model(path, tsp_q, tsp_graph_nodes):
     model = tsp_q.model
@@ -1214,36 +791,25 @@ def get_tour_from_trained_model(path, tsp_q, tsp_graph_nodes):
 
     tour = [0]
     tour_edges = []
-    available_nodes = list(range(1, len(tsp_graph_nodes)))
-
-    node_to_qubit_map = {}
-    for i, node in enumerate(tsp_graph_nodes):
-        node_to_qubit_map[node] = i
-
-    fully_connected_edges = []
-    fully_connected_edges_ix = list(combinations(list(range(len(tsp_graph_nodes))), 2))
-    edge_weights = {}
-    edge_weights_ix = {}
-    for edge in fully_connected_edges_ix:
-        fully_connected_edges.append((tsp_graph_nodes[edge[0]], tsp_graph_nodes[edge[1]]))
-        edge_distance = np.linalg.norm(np.asarray(tsp_graph_nodes[edge[0]]) - np.asarray(tsp_graph_nodes[edge[1]]))
-        edge_weights[(tsp_graph_nodes[edge[0]], tsp_graph_nodes[edge[1]])] = edge_distance
-        edge_weights_ix[edge] = edge_distance
+    available_mask = np.ones(len(tsp_graph_nodes), dtype=bool)
+    available_mask[0] = False
+
+    edges = tsp_q.fully_connected_qubits_arr
+    edge_distances = compute_distance_matrix(tsp_graph_nodes)[edges[:, 0], edges[:, 1]]
+    edge_weights = edge_distances.astype(np.float32)
+    edge_feat = np.arctan(edge_distances)
 
     for i in range(len(tsp_graph_nodes)):
-        state_list = tsp_q.graph_to_list(
-            tsp_graph_nodes, fully_connected_edges, edge_weights,
-            available_nodes, node_to_qubit_map)
+        state_list = tsp_q.graph_to_list(edge_feat, available_mask)
 
-        next_node = tsp_q.get_action(state_list, available_nodes, tour_edges, edge_weights_ix)
+        next_node = tsp_q.get_action(state_list, available_mask, tour_edges, edge_weights)
         tour_edges.append((tour[-1], next_node))
         tour.append(next_node)
 
-        remove_node_ix = available_nodes.index(next_node)
-        del available_nodes[remove_node_ix]
+        available_mask[next_node] = False
 
-        if len(available_nodes) == 1:
-            tour.append(available_nodes[0])
+        if np.count_nonzero(available_mask) == 1:
+            tour.append(int(np.flatnonzero(available_mask)[0]))
             break
 
     return tour
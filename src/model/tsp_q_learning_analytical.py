@@ -0,0 +1,291 @@
+import pickle
+import random
+from random import choice
+
+import numpy as np
+
+from config import BASE_PATH
+from src.utils.analytic_exp_vals import compute_analytic_q_vals
+from src.utils.helpers import compute_distance_matrix, compute_tour_length_from_distances
+from src.model.q_learning import QLearning, ReplayBuffer
+from collections import deque
+
+
+class QLearningTspAnalytical(QLearning):
+    def __init__(
+            self,
+            hyperparams,
+            save=True,
+            save_as=None,
+            test=False,
+            path=BASE_PATH):
+
+        super(QLearningTspAnalytical, self).__init__(hyperparams, save, save_as, test, path)
+
+        self.data_path = hyperparams.get('data_path')
+        # edge weight matrix of each instance, shared by all of its transitions
+        self.instance_W_table = {}
+
+        self.epsilon_fd = 0.005  # epsilon for finite difference gradient
+
+        self.params = np.array([1.1, 1.])
+        self.target_params = self.params.copy()
+
+        # Adam hyperparams, the moment estimates are kept per parameter
+        self.t = 0
+        self.m_t = np.zeros_like(self.params)
+        self.v_t = np.zeros_like(self.params)
+        self.beta_1 = 0.9
+        self.beta_2 = 0.999
+
+        # compile the numba kernels once up front
+        in_tour = np.zeros(self.n_vars, dtype=bool)
+        in_tour[0] = True
+        self.q_vals_from_prepared(
+            (np.zeros(1, dtype=np.int64), in_tour[None], np.zeros((1, self.n_vars, self.n_vars))), self.params)
+
+    def initialize_memory(self):
+        '''
+        A partial tour is stored as its last node and a bitmask of the nodes
+        in it (bit i set if node i is in the tour, so n_vars <= 64). The tour
+        after the action follows from these and the action.
+        '''
+        return ReplayBuffer(self.memory_length, {
+            'last_node': ((), np.int64),
+            'tour_mask': ((), np.uint64),
+            'action': ((), np.int64),
+            'reward': ((), np.float32),
+            'done': ((), np.float32),
+            'instance': ((), np.int32)})
+
+    def save_data(self, meta, tour_lengths, optimal_tour_lengths):
+        self.save_history_async(meta, tour_lengths, optimal_tour_lengths)
+
+        with open(self.path + '{}_params.pickle'.format(self.save_as), 'wb') as file:
+            pickle.dump(self.params, file)
+
+    def _prepare_batch(self, training_batch):
+        '''
+        (last nodes, in-tour masks, stacked (n, n) edge weight matrices) of the
+        tours before and after the actions of a sampled batch, shared by all
+        q-value evaluations on that batch.
+        '''
+        edge_weights = np.stack([self.instance_W_table[x] for x in training_batch.instance])
+        tour_masks = training_batch.tour_mask
+        next_tour_masks = tour_masks | (np.uint64(1) << training_batch.action.astype(np.uint64))
+
+        return ((training_batch.last_node, self.unpack_tour_masks(tour_masks), edge_weights),
+                (training_batch.action, self.unpack_tour_masks(next_tour_masks), edge_weights))
+
+    def unpack_tour_masks(self, tour_masks):
+        '''
+        (batch, n_vars) boolean in-tour masks from the tour bitmasks.
+        '''
+        bits = np.arange(self.n_vars, dtype=np.uint64)
+        return ((tour_masks[:, None] >> bits) & np.uint64(1)).astype(bool)
+
+    def q_vals_from_prepared(self, prepared_batch, params):
+        '''
+        Q-values of extending each partial tour by each node, using the analytic
+        expectation of the next edge. Nodes already in the tour get -10000.
+        '''
+        last_nodes, in_tour, edge_weights = prepared_batch
+        return compute_analytic_q_vals(params[0], params[1], last_nodes, in_tour, edge_weights)
+
+    def get_action(self, available_mask, last_node, edge_weights):
+        # Note: in this signature, there is no state tensor.
+        # The q-values are only computed when acting greedily; visited nodes are
+        # already masked to -10000 there, so argmax never picks them.
+        if np.random.uniform() < self.epsilon:
+            action = int(choice(np.flatnonzero(available_mask)))
+        else:
+            q_vals = self.q_vals_from_prepared(
+                (np.array([last_node]), ~available_mask[None], edge_weights[None]), self.params)[0]
+            action = int(q_vals.argmax())
+
+        return action
+
+    @staticmethod
+    def cost(distances, tour):
+        return -compute_tour_length_from_distances(distances, tour)
+
+    def compute_reward(self, distances, old_state, state):
+        return self.cost(distances, state) - self.cost(distances, old_state)
+
+    def compute_fd_loss_gradient(self, prepared_batch, actions, target_q_values):
+        '''
+        Computes the gradient of the loss function w.r.t. to the parameters of the model using finite differences.
+        
+        Finite difference is used to approximate the derivative of a function
+        when the analytical derivative is difficult to obtain.
+        
+        The method specifically calculates how the loss function changes w.r.t
+        to small changes in the parameters of the model (self.params)
+
+        Each (shifted) parameter set is evaluated on the whole batch at once.
+        '''
+        batch_ix = np.arange(len(actions))
+        q_vals = self.q_vals_from_prepared(prepared_batch, self.params)[batch_ix, actions]
+        losses = (target_q_values - q_vals)**2 # squared error
+
+        # row i: q-values of the batch with parameter i shifted by epsilon_fd
+        q_vals_shifted = np.empty((len(self.params), len(actions)))
+        for i in range(len(self.params)):
+            shifted_params = self.params.copy()
+            shifted_params[i] += self.epsilon_fd
+            q_vals_shifted[i] = self.q_vals_from_prepared(prepared_batch, shifted_params)[batch_ix, actions]
+        derivatives = ((target_q_values - q_vals_shifted)**2 - losses) / self.epsilon_fd
+
+        return derivatives.mean(axis=1), losses.mean()
+
+    def train_step(self):
+        training_batch = self.memory.sample(self.batch_size)
+
+        actions = training_batch.action
+        rewards = training_batch.reward
+        done = training_batch.done
+        # the tour bookkeeping is done once for the target and all fd passes
+        prepared_batch, prepared_next_batch = self._prepare_batch(training_batch)
+
+        future_q_vals = self.q_vals_from_prepared(prepared_next_batch, self.target_params)
+        # best next action of each sample
+        target_q_values = rewards + (
+                self.gamma * future_q_vals.max(axis=1) * (1.0 - done))
+
+        gradient, loss = self.compute_fd_loss_gradient(prepared_batch, actions, target_q_values)
+        self.t += 1
+        # update first moment estimate
+        self.m_t = (self.beta_1 * self.m_t) + ((1 - self.beta_1) * gradient)
+        # update second moment estimate
+        self.v_t = (self.beta_2 * self.v_t) + ((1 - self.beta_2) * gradient ** 2)
+        # bias correction for first moment estimate
+        m_cap = self.m_t / (1 - self.beta_1 ** self.t)
+        # bias correction for second moment estimate
+        v_cap = self.v_t / (1 - self.beta_2 ** self.t)
+        # small value to avoid dividing by 0
+        v_temp = np.sqrt(v_cap) + self.epsilon
+        # compute gradient using adaptive learning rate = 1
+        grad = 1 * m_cap / v_temp
+        self.params = self.params - self.learning_rate * grad
+
+        return loss
+
+    def perform_episodes(self, num_instances):
+        self.meta['num_instances'] = num_instances
+        self.meta['best_tour_length'] = 100000
+        self.meta['best_tour'] = []
+        self.meta['best_tour_ix'] = 0
+        self.meta['env_solved'] = False
+
+        with open(self.data_path, 'rb') as file:
+            data = pickle.load(file)
+
+        x_train = data['x_train'][:num_instances]
+        y_train = data['y_train'][:num_instances]
+
+        tour_length_history = []
+        optimal_tour_length_history = []
+        # ratios of the 100 most recent episodes and their sum
+        ratio_window = deque(maxlen=100)
+        window_sum = 0.
+        running_avgs = []
+        running_avg = 0
+
+        for episode in range(self.episodes):
+            instance_number = random.randint(0, num_instances-1)
+            # instance_number = 0
+            tsp_graph_nodes = x_train[instance_number]
+            edge_weights_ix = self.instance_W_table.get(instance_number)
+            if edge_weights_ix is None:
+                # euclidean distances between all nodes, i.e. the symmetric edge weight matrix
+                edge_weights_ix = compute_distance_matrix(tsp_graph_nodes)
+                self.instance_W_table[instance_number] = edge_weights_ix
+            optimal_tour_length = compute_tour_length_from_distances(
+                edge_weights_ix, [int(x - 1) for x in y_train[instance_number][:-1]])
+
+            tour = [0]  # w.l.o.g. we always start at city 0
+            available_mask = np.ones(self.n_vars, dtype=bool)
+            available_mask[0] = False
+            tour_mask = 1 # bit i is set once node i is in the tour
+
+            for i in range(self.n_vars):
+                prev_tour = tour[:]
+                prev_tour_mask = tour_mask
+                next_node = self.get_action(available_mask, tour[-1], edge_weights_ix)
+                tour.append(next_node)
+
+                available_mask[next_node] = False
+                tour_mask |= 1 << next_node
+                n_available = np.count_nonzero(available_mask)
+
+                if len(tour) > 1:
+                    reward = self.compute_reward(edge_weights_ix, prev_tour, tour)
+
+                    done = 0 if n_available > 1 else 1
+                    transition = (prev_tour[-1], prev_tour_mask, next_node, reward, done, instance_number)
+                    self.memory.append(transition)
+
+                if n_available == 1:
+                    prev_tour = tour[:]
+                    last_node = int(np.flatnonzero(available_mask)[0])
+                    tour.append(last_node)
+                    tour.append(tour[0])
+                    reward = self.compute_reward(edge_weights_ix, prev_tour, tour)
+
+                    transition = (next_node, tour_mask, last_node, reward, 1, instance_number)
+                    self.memory.append(transition)
+                    break
+
+            tour_length = compute_tour_length_from_distances(edge_weights_ix, tour)
+            tour_length_history.append(tour_length)
+            optimal_tour_length_history.append(optimal_tour_length)
+
+            if tour_length < self.meta.get('best_tour_length'):
+                self.meta['best_tour_length'] = tour_length
+                self.meta['best_tour'] = tour
+                self.meta['best_tour_ix'] = instance_number
+
+            if len(self.memory) >= self.batch_size:
+                if episode % self.update_after == 0:
+                    loss = self.train_step()
+                    print(
+                        f"Episode {episode}, loss {loss}, running avg {running_avg}, epsilon {self.epsilon}")
+                    print(f"\tFinal tour: {tour}")
+                else:
+                    print(
+                            f"Episode {episode}, running avg {running_avg}, epsilon {self.epsilon}")
+                    print(f"\tFinal tour: {tour}")
+
+                if episode % self.update_target_after == 0:
+                    self.target_params = self.params.copy()
+
+            self.epsilon = max(self.epsilon_min, self.epsilon_decay * self.epsilon)
+
+            if self.save and episode % self.save_after == 0:
+                self.save_data(self.meta, tour_length_history, optimal_tour_length_history)
+
+            ratio = tour_length_history[-1] / optimal_tour_length
+            if len(ratio_window) == ratio_window.maxlen:
+                window_sum -= ratio_window[0] # drops out of the window on append
+            ratio_window.append(ratio)
+            window_sum += ratio
+            running_avg = window_sum / len(ratio_window)
+
+            running_avgs.append(running_avg)
+
+            if len(ratio_window) >= 100 and running_avg <= 1.02:
+                print(f"Environment solved in {episode+1} episodes!")
+                self.meta['env_solved'] = True
+                break
+
+        if self.save:
+            self.save_data(self.meta, tour_length_history, optimal_tour_length_history)
+            self.wait_for_save()
+
+        if self.test:
+            import matplotlib.pyplot as plt
+            plt.plot(running_avgs)
+            plt.ylabel("Ratio to optimal tour length")
+            plt.xlabel("Episode")
+            plt.title("Running average over past 100 episodes")
+            plt.show()
@@ -1,20 +1,43 @@
 import numpy as np
+from numba import njit
 
 
+@njit(cache=True, fastmath=True)
 def compute_analytic_expectation(beta, gamma, i, j, n, edge_weights, available_node='i'):
-    weight_ij = edge_weights.get((i, j), edge_weights.get((j, i)))
-    prod = 1
-    if available_node == 'i':
+    '''
+    Analytic expectations of the edges (i, j[m]) for an array of nodes j.
+    edge_weights is the symmetric (n, n) edge weight matrix of the instance.
+    '''
+    expectations = np.empty(len(j))
+    for m in range(len(j)):
+        if available_node == 'i':
+            node, other = i, j[m]
+        else:
+            node, other = j[m], i
+        prod = 1.
         for k in range(n):
-            if k != j and k != i:
-                weight = edge_weights.get((i, k), edge_weights.get((k, i)))
-                prod *= np.cos(np.arctan(weight) * gamma)
-    elif available_node == 'j':
-        for k in range(n):
-            if k != i and k != j:
-                weight = edge_weights.get((j, k), edge_weights.get((k, j)))
-                prod *= np.cos(np.arctan(weight) * gamma)
+            if k != node and k != other:
+                prod *= np.cos(np.arctan(edge_weights[node, k]) * gamma)
+        expectations[m] = np.sin(beta * np.pi) * np.sin(np.arctan(edge_weights[i, j[m]]) * gamma) * prod
+
+    return expectations
+
 
-    expectation = np.sin(beta * np.pi) * np.sin(np.arctan(weight_ij) * gamma) * prod
+@njit(cache=True, fastmath=True)
+def compute_analytic_q_vals(beta, gamma, last_nodes, in_tour, edge_weights):
+    '''
+    Q-values of extending each partial tour, given by its last node and in-tour
+    mask, by each node j, from the expectation of the next edge (last_node, j).
+    edge_weights is a (batch, n, n) stack. Nodes already in the tour get -10000.
+    '''
+    batch_size, n = in_tour.shape
+    q_vals = np.full((batch_size, n), -10000.)
+    for tour_ix in range(batch_size):
+        last_node = last_nodes[tour_ix]
+        j = np.flatnonzero(~in_tour[tour_ix])
+        expectations = compute_analytic_expectation(
+            beta, gamma, last_node, j, n, edge_weights[tour_ix], 'j')
+        for m in range(len(j)):
+            q_vals[tour_ix, j[m]] = edge_weights[tour_ix, last_node, j[m]] * expectations[m]
 
-    return expectation
+    return q_vals
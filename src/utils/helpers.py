@@ -1,4 +1,3 @@
-
 import numpy as np
 import networkx as nx
 
@@ -11,11 +10,28 @@ def compute_tour_length(nodes, tour):
     :param tour: list of node indices denoting a (potentially partial) tour
     :return: tour length
     """
-    tour_length = 0
-    for i in range(len(tour)):
-        if i < len(tour)-1:
-            tour_length += np.linalg.norm(np.asarray(nodes[tour[i]]) - np.asarray(nodes[tour[i+1]]))
-        else:
-            tour_length += np.linalg.norm(np.asarray(nodes[tour[-1]]) - np.asarray(nodes[tour[0]]))
+    nodes = np.asarray(nodes, dtype=np.float64)
+    tour = np.asarray(tour)
+    return np.linalg.norm(nodes[tour] - nodes[np.roll(tour, -1)], axis=1).sum()
+
+
+def compute_distance_matrix(nodes):
+    """
+    Compute the pairwise euclidean distances between all nodes.
+    :param nodes: all nodes in the graph in form of (x, y) coordinates
+    :return: symmetric (n, n) matrix of distances
+    """
+    nodes = np.asarray(nodes, dtype=np.float64)
+    diffs = nodes[:, None, :] - nodes[None, :, :]
+    return np.sqrt((diffs * diffs).sum(axis=-1))
 
-    return tour_length
\ No newline at end of file
+
+def compute_tour_length_from_distances(distances, tour):
+    """
+    Same as compute_tour_length, but looks the edge lengths up in a precomputed distance matrix.
+    :param distances: (n, n) matrix of distances between the nodes, see compute_distance_matrix
+    :param tour: list of node indices denoting a (potentially partial) tour
+    :return: tour length
+    """
+    tour = np.asarray(tour)
+    return distances[tour, np.roll(tour, -1)].sum()
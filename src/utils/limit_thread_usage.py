@@ -2,11 +2,14 @@
 import os
 
 
-def set_thread_usage_limit(num_threads, tf):
+def set_thread_usage_limit(num_threads, tf=None):
     os.environ["OMP_NUM_THREADS"] = str(num_threads)
     os.environ["TF_NUM_INTRAOP_THREADS"] = str(num_threads)
     os.environ["TF_NUM_INTEROP_THREADS"] = str(num_threads)
 
+    if tf is None:
+        return
+
     tf.config.threading.set_inter_op_parallelism_threads(num_threads)
     tf.config.threading.set_intra_op_parallelism_threads(num_threads)
     tf.config.set_soft_device_placement(True)